@@ -1,10 +1,21 @@
-import email as lib_email
+import base64
+import binascii
+import concurrent.futures
+import email.parser
+import email.policy
+import functools
 import getpass
 import logging
 import mimetypes
+import os
 import pathlib
+import queue
+import quopri
+import secrets
+import string
+import threading
+import uuid
 from mailbox import Message
-from string import Template
 from typing import Generator
 
 import click
@@ -13,6 +24,28 @@ from imapclient import IMAPClient
 
 logger = logging.getLogger(__name__)
 
+# Number of parallel IMAP connections. Gmail allows around 15 concurrent
+# sessions per account, so this should stay well below that.
+MAX_WORKERS = 4
+
+# Maximum number of attachments queued between the fetch workers and the
+# thread writing them to disk.
+QUEUE_SIZE = 8
+
+# Translation table mapping every character that is not safe in a filename
+# to an underscore, so sanitizing is a single C-level translate call.
+_ALLOWED_FNAME_CHARS = frozenset(string.ascii_letters + string.digits + "_.- ")
+_SANITIZE_TABLE = str.maketrans(
+    {chr(i): chr(i) if chr(i) in _ALLOWED_FNAME_CHARS else "_" for i in range(256)}
+)
+
+# Reused parser instance so a new BytesParser is not allocated per message.
+_PARSER = email.parser.BytesParser(policy=email.policy.compat32)
+
+# How many base64 characters are decoded per chunk when streaming an
+# attachment to disk. Must stay a multiple of the 4-character quantum.
+DECODE_CHUNK = 64 * 1024
+
 
 @click.command()
 @click.option(
@@ -52,123 +85,454 @@ logger = logging.getLogger(__name__)
     "-m",
     help="MIME Type to filter attachments(guessed from extension by default)",
 )
-def main(email, inbox, search, folder, file_ext, mime_type):
+@click.option(
+    "--fetch-batch-size",
+    "-b",
+    default=100,
+    show_default=True,
+    help="Number of messages fetched per IMAP request",
+)
+@click.option(
+    "--watch",
+    "-w",
+    type=int,
+    help="Keep running, checking again when new mail arrives or after this "
+    "many minutes, reusing the same connection",
+)
+def main(email, inbox, search, folder, file_ext, mime_type, fetch_batch_size, watch):
     logging.basicConfig(level=logging.INFO, format="%(message)s")
 
-    logger.info(
-        Template("Script initialized with the arguments: $arguments").safe_substitute(
-            arguments=click.get_os_args()
-        )
-    )
+    logger.info("Script initialized with the arguments: %s", click.get_os_args())
 
     service_name = "gmail_attachment_downloader"
-    passwd = keyring.get_password(service_name, email)
+    passwd = get_stored_password(service_name, email)
     if passwd:
-        logger.info(
-            Template(
-                "Retrieved password from keyring for email $address"
-            ).safe_substitute(address=email)
-        )
+        logger.info("Retrieved password from keyring for email %s", email)
     else:
         logger.info("Password not stored, asking user")
         passwd = getpass.getpass()
         keyring.set_password(service_name, email, passwd)
+        # Forget the cached miss so later lookups see the stored password.
+        get_stored_password.cache_clear()
 
-    with IMAPClient(host="imap.gmail.com", ssl=993) as imap_client:
-        logger.info("Connected to IMAP server, attempting login")
-        imap_client.login(email, passwd)
-        logger.info(
-            Template('Selecting inbox folder "$inbox"').safe_substitute(inbox=inbox)
-        )
-        imap_client.select_folder(inbox, readonly=True)
-        search_terms = Template("has:attachment ${search}").safe_substitute(
-            search=search
-        )
-        logger.info(
-            Template('Applying gmail search with the terms: "$terms"').safe_substitute(
-                terms=search_terms
-            )
-        )
+    search_terms = f"has:attachment {search}"
+    logger.info('Applying gmail search with the terms: "%s"', search_terms)
 
-        if not mime_type:
-            made_up_fname = Template("${name}.${file_ext}").safe_substitute(
-                name="name", file_ext=file_ext
-            )
-            mime_type, _ = mimetypes.guess_type(made_up_fname)
-            logger.info(
-                Template('Guessed mimetype from "${ext}" as "${mime}"').safe_substitute(
-                    ext=file_ext, mime=mime_type
-                )
-            )
+    if not mime_type:
+        made_up_fname = f"name.{file_ext}"
+        mime_type, _ = mimetypes.guess_type(made_up_fname)
+        logger.info('Guessed mimetype from "%s" as "%s"', file_ext, mime_type)
 
-        for filename, attachment in fetch_attachments(
-            imap_client, mime_type, search_terms
-        ):
-            filepath = pathlib.Path(folder) / pathlib.Path(
-                find_unused_filename(filename, file_ext, folder)
+    folder_path = pathlib.Path(folder)
+    existing_names = ensure_directory_exists(folder)
+    # UIDs already handled in earlier passes, so an IDLE wake in watch
+    # mode only downloads messages that arrived since.
+    processed_uids = set()
+
+    imap_client = connect(email, passwd, inbox)
+    try:
+        while True:
+            download_attachments(
+                imap_client,
+                email,
+                passwd,
+                inbox,
+                mime_type,
+                search_terms,
+                fetch_batch_size,
+                folder_path,
+                file_ext,
+                existing_names,
+                processed_uids,
             )
-            with open(filepath, "wb") as file:
-                file.write(attachment)
+            if watch is None:
+                break
+            logger.info("Waiting up to %s minute(s) for new mail", watch)
+            try:
+                imap_client.idle()
+                imap_client.idle_check(timeout=watch * 60)
+                imap_client.idle_done()
+            except IMAPClient.AbortError:
+                logger.info("Connection lost while idling, reconnecting")
+                imap_client = connect(email, passwd, inbox)
+    finally:
+        try:
+            imap_client.logout()
+        except (OSError, IMAPClient.Error):
+            pass
+
+
+@functools.lru_cache(maxsize=4)
+def get_stored_password(service_name: str, email: str) -> str:
+    """
+    Fetches a password from the OS keyring, cached per process because the
+    keyring backends go through slow secret-store RPC
+    """
+    return keyring.get_password(service_name, email)
+
+
+def ensure_directory_exists(folder: str) -> set:
+    """
+    Creates the attachments folder if needed and returns the names already
+    taken in it, visiting the directory a single time
+    :param folder: folder where attachments will be saved
+    :return: set of filenames already present in the folder
+    """
+    os.makedirs(folder, exist_ok=True)
+    with os.scandir(folder) as entries:
+        return {entry.name for entry in entries}
+
 
-            logger.info(
-                Template('Saved file "${filename}" at "${filepath}"').safe_substitute(
-                    filename=filename, filepath=filepath
-                )
+def connect(email: str, passwd: str, inbox: str) -> IMAPClient:
+    """
+    Opens an IMAP connection logged in and with the inbox selected
+    """
+    imap_client = IMAPClient(host="imap.gmail.com", ssl=993)
+    logger.info("Connected to IMAP server, attempting login")
+    imap_client.login(email, passwd)
+    logger.info('Selecting inbox folder "%s"', inbox)
+    imap_client.select_folder(inbox, readonly=True)
+    return imap_client
+
+
+def download_attachments(
+    imap_client: IMAPClient,
+    email: str,
+    passwd: str,
+    inbox: str,
+    mime_type: str,
+    search_terms: str,
+    batch_size: int,
+    folder_path: pathlib.Path,
+    file_ext: str,
+    existing_names: set,
+    processed_uids: set,
+):
+    """
+    Runs one full search and download pass, saving every matching
+    attachment into the folder
+    """
+    for filename, encoding, payload in fetch_attachments(
+        imap_client,
+        email,
+        passwd,
+        inbox,
+        mime_type,
+        search_terms,
+        batch_size,
+        processed_uids,
+    ):
+        filepath = folder_path / find_unused_filename(
+            filename, file_ext, existing_names
+        )
+        # Raw file descriptor so decoded chunks go straight to the kernel,
+        # with no stdio buffering or per-file sync.
+        # O_EXCL catches the one-in-billions random suffix collision.
+        try:
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            existing_names.add(filepath.name)
+            filepath = folder_path / find_unused_filename(
+                filename, file_ext, existing_names
             )
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            write_attachment(payload, encoding, fd)
+        finally:
+            os.close(fd)
+        existing_names.add(filepath.name)
+
+        logger.info('Saved file "%s" at "%s"', filename, filepath)
+
+    # One flush for the whole batch, amortizing the sync cost that would
+    # otherwise be paid per file. Not available on Windows.
+    if hasattr(os, "sync"):
+        os.sync()
 
 
-def fetch_attachments(imap_client: IMAPClient, mime_type: str, search_terms: str):
+def fetch_attachments(
+    imap_client: IMAPClient,
+    email: str,
+    passwd: str,
+    inbox: str,
+    mime_type: str,
+    search_terms: str,
+    batch_size: int,
+    processed_uids: set,
+):
     messages = imap_client.gmail_search(search_terms)
+    messages = [uid for uid in messages if uid not in processed_uids]
+    processed_uids.update(messages)
 
-    logger.info(
-        Template("Number of messages found: $num_msg").safe_substitute(
-            num_msg=len(messages)
+    logger.info("Number of messages found: %s", len(messages))
+
+    shards = (messages[i::MAX_WORKERS] for i in range(MAX_WORKERS))
+    shards = [shard for shard in shards if shard]
+    # Bounded so workers block instead of piling up fetched attachments in
+    # memory faster than the main thread can write them to disk.
+    attachment_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    # Set when the consumer stops reading, so workers blocked on a full
+    # queue can bail out instead of deadlocking the executor shutdown.
+    stop_event = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                fetch_worker,
+                email,
+                passwd,
+                inbox,
+                mime_type,
+                shard,
+                batch_size,
+                attachment_queue,
+                stop_event,
+            )
+            for shard in shards
+        ]
+        pending = len(futures)
+        try:
+            while pending:
+                item = attachment_queue.get()
+                if item is None:
+                    pending -= 1
+                    continue
+                yield item
+            for future in futures:
+                future.result()
+        finally:
+            stop_event.set()
+
+
+def fetch_worker(
+    email: str,
+    passwd: str,
+    inbox: str,
+    mime_type: str,
+    messages: list,
+    batch_size: int,
+    attachment_queue: queue.Queue,
+    stop_event: threading.Event,
+):
+    try:
+        with connect(email, passwd, inbox) as imap_client:
+            for chunk_start in range(0, len(messages), batch_size):
+                if stop_event.is_set():
+                    return
+                chunk = messages[chunk_start : chunk_start + batch_size]
+                response = imap_client.fetch(chunk, ["BODYSTRUCTURE"])
+                for msg_id, data in response.items():
+                    parts = find_attachment_parts(data[b"BODYSTRUCTURE"], mime_type)
+                    if parts is None:
+                        fetch_whole_message(
+                            imap_client, msg_id, mime_type, attachment_queue, stop_event
+                        )
+                        continue
+                    for section, filename, encoding in parts:
+                        peek_key = f"BODY.PEEK[{section}]"
+                        body_key = f"BODY[{section}]"
+                        part_response = imap_client.fetch([msg_id], [peek_key])
+                        raw_part = part_response[msg_id][body_key.encode()]
+                        queue_put(
+                            attachment_queue, (filename, encoding, raw_part), stop_event
+                        )
+    finally:
+        queue_put(attachment_queue, None, stop_event)
+
+
+def queue_put(attachment_queue: queue.Queue, item, stop_event: threading.Event):
+    """
+    Puts an item on the bounded queue, polling the stop event so a worker
+    blocked on a full queue gives up once the consumer is gone
+    """
+    while not stop_event.is_set():
+        try:
+            attachment_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def fetch_whole_message(
+    imap_client: IMAPClient,
+    msg_id: int,
+    mime_type: str,
+    attachment_queue: queue.Queue,
+    stop_event: threading.Event,
+):
+    """
+    Fallback for messages whose BODYSTRUCTURE could not be interpreted:
+    fetches the entire message and walks its MIME tree
+    """
+    response = imap_client.fetch([msg_id], ["BODY.PEEK[]"])
+    raw = _PARSER.parsebytes(response[msg_id][b"BODY[]"])
+    for msg in get_attachment_msgs(raw, mime_type):
+        cte = msg.get("Content-Transfer-Encoding", "").lower()
+        queue_put(
+            attachment_queue, (msg.get_filename(), cte, msg.get_payload()), stop_event
         )
-    )
 
-    response = imap_client.fetch(
-        messages, ["FLAGS", "BODY", "RFC822.SIZE", "ENVELOPE", "RFC822"]
-    )
-    for _, data in response.items():
-        raw = lib_email.message_from_bytes(data[b"RFC822"])
-        for msg in get_attachment_msgs(raw, mime_type):
-            yield msg.get_filename(), msg.get_payload(decode=True)
 
+def write_attachment(payload, encoding: str, fd: int):
+    """
+    Decodes a still-encoded payload straight into a file descriptor,
+    chunk by chunk for base64, so the decoded attachment never has to
+    exist in memory as one full-size bytes object
+    :param payload: raw payload as fetched, before transfer decoding
+    :param encoding: the part's Content-Transfer-Encoding
+    :param fd: file descriptor the decoded bytes are written to
+    """
+    if encoding == "base64":
+        if isinstance(payload, str):
+            payload = payload.encode("ascii", "ignore")
+        # All whitespace is stripped so fixed-size slices stay aligned to
+        # the four-character base64 quantum.
+        payload = payload.translate(None, b" \t\r\n\v\f")
+        try:
+            for start in range(0, len(payload), DECODE_CHUNK):
+                os.write(fd, binascii.a2b_base64(payload[start : start + DECODE_CHUNK]))
+        except binascii.Error:
+            # Malformed base64 broke the chunk alignment; redo the file
+            # with one whole-payload decode, saving the payload undecoded
+            # when even that fails, like get_payload(decode=True) did.
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            try:
+                os.write(fd, base64.b64decode(payload))
+            except binascii.Error:
+                os.write(fd, payload)
+    elif encoding == "quoted-printable":
+        os.write(fd, quopri.decodestring(payload))
+    else:
+        os.write(fd, payload.encode() if isinstance(payload, str) else payload)
+
+
+def find_attachment_parts(bodystructure, mime_type: str, section_prefix: str = ""):
+    """
+    Walks a BODYSTRUCTURE response collecting the attachment parts that
+    match the wanted MIME type, so only those parts need to be fetched
+    :param bodystructure: BodyData tuple returned by IMAPClient
+    :param mime_type: MIME type the attachments are filtered by
+    :param section_prefix: section number of the enclosing part
+    :return: a list of (section, filename, encoding) tuples, or None when
+             the structure could not be interpreted
+    """
+    try:
+        if bodystructure.is_multipart:
+            parts = []
+            for index, child in enumerate(bodystructure[0], start=1):
+                section = f"{section_prefix}.{index}" if section_prefix else str(index)
+                child_parts = find_attachment_parts(child, mime_type, section)
+                if child_parts is None:
+                    return None
+                parts.extend(child_parts)
+            return parts
 
-def msg_has_attachment(msg: Message) -> bool:
-    return (
-        msg.get_content_type() != "multipart"
-        and msg.get("Content-Disposition")
-        and msg.get_filename()
-    )
+        maintype, subtype = bodystructure[0], bodystructure[1]
+        if not isinstance(maintype, bytes) or not isinstance(subtype, bytes):
+            return None
+        content_type = (maintype + b"/" + subtype).decode().lower()
+        if content_type == "message/rfc822":
+            # Attachments can hide inside a forwarded message; only the
+            # full-message parser can walk into those.
+            return None
+        if content_type != mime_type:
+            return []
+        filename = part_filename(bodystructure)
+        if not filename:
+            # No plain FILENAME/NAME parameter: the name may be RFC 2231
+            # encoded (FILENAME*), which the fallback parser can decode.
+            return None
+        encoding = bodystructure[5]
+        encoding = encoding.decode().lower() if isinstance(encoding, bytes) else ""
+        return [(section_prefix or "1", filename, encoding)]
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return None
+
+
+def part_filename(part) -> str:
+    """
+    Extracts the attachment filename from a non-multipart BODYSTRUCTURE
+    part, preferring the Content-Disposition filename over the
+    Content-Type name parameter
+    """
+    for field in part[7:]:
+        if isinstance(field, tuple) and len(field) == 2 and isinstance(field[1], tuple):
+            filename = param_value(field[1], b"FILENAME")
+            if filename:
+                return filename
+    return param_value(part[2], b"NAME")
+
+
+def param_value(params, key: bytes):
+    """
+    Looks up a value in a BODYSTRUCTURE parameter list, which alternates
+    keys and values
+    """
+    if not params:
+        return None
+    for index in range(0, len(params) - 1, 2):
+        if params[index].upper() == key:
+            return params[index + 1].decode()
+    return None
 
 
 def get_attachment_msgs(msg: Message, mime_type: str) -> Generator:
-    return (
-        msg
-        for msg in msg.walk()
-        if msg_has_attachment(msg) and msg.get_content_type() == mime_type
-    )
+    """
+    Walks a message's MIME tree yielding the parts that are attachments
+    with the wanted MIME type, cheapest checks first
+    """
+    stack = [msg]
+    while stack:
+        part = stack.pop()
+        # Covers multipart/* containers and message/rfc822, whose payload
+        # is also a list of subparts, matching what msg.walk() descended.
+        if part.is_multipart():
+            stack.extend(part.get_payload())
+            continue
+        if (
+            part.get_content_type() == mime_type
+            and part.get("Content-Disposition")
+            and part.get_filename()
+        ):
+            yield part
 
 
-def find_unused_filename(
-    payload_fname: str, file_ext: str, folder: str
-) -> pathlib.Path:
+def sanitize_filename(filename: str) -> str:
+    """
+    Replaces characters that are not safe in filenames with an underscore
+    :param filename: filename taken from the attachment
+    :return: the sanitized filename
+    """
+    return filename.translate(_SANITIZE_TABLE)
+
+
+def find_unused_filename(payload_fname: str, file_ext: str, existing_names: set) -> str:
     """
     Finds an unused filename for the attachment to be saved at
     :param payload_fname: filename used in the attachment
     :param file_ext: extension that new generated filenames will have
-    :param folder: folder where files will be saved
+    :param existing_names: filenames already taken in the folder
     :return: a filename that is not used
     """
-    counter = 1
-    fname = payload_fname
-    while not fname or (pathlib.Path(folder) / pathlib.Path(fname)).exists():
-        fname = Template("attachment$counter.$file_ext").safe_substitute(
-            counter=counter, file_ext=file_ext
-        )
-        counter += 1
-    return pathlib.Path(folder) / pathlib.Path(fname)
+    fname = sanitize_filename(payload_fname) if payload_fname else None
+    if not fname:
+        return f"attachment_{generate_random_string()}.{file_ext}"
+    if fname not in existing_names:
+        return fname
+    # A fresh 8-hex suffix collides with roughly 1 in 4 billion odds, so
+    # there is no retry loop; the writer's O_EXCL open covers the rare miss.
+    head, sep, tail = fname.rpartition(".")
+    base_name, ext = (head, sep + tail) if sep else (fname, "")
+    return f"{base_name}_{uuid.uuid4().hex[:8]}{ext}"
+
+
+def generate_random_string(length: int = 6) -> str:
+    """
+    Generates a random string used to make generated filenames unique
+    :param length: number of characters in the string
+    :return: the random string
+    """
+    return secrets.token_urlsafe(length)[:length]
 
 
 if __name__ == "__main__":